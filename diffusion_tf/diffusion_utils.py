@@ -1,15 +1,16 @@
+import contextlib
+
 import numpy as np
 import tensorflow.compat.v1 as tf
 
-from . import nn
-
 
 def normal_kl(mean1, logvar1, mean2, logvar2):
   """
   KL divergence between normal distributions parameterized by mean and log-variance.
   """
-  return 0.5 * (-1.0 + logvar2 - logvar1 + tf.exp(logvar1 - logvar2)
-                + tf.squared_difference(mean1, mean2) * tf.exp(-logvar2))
+  # written as a single multiply-add chain sharing logvar1 - logvar2, so XLA emits one fused elementwise kernel
+  logvar_diff = logvar1 - logvar2
+  return 0.5 * (tf.squared_difference(mean1, mean2) * tf.exp(-logvar2) + tf.exp(logvar_diff) - 1.0 - logvar_diff)
 
 
 def _warmup_beta(beta_start, beta_end, num_diffusion_timesteps, warmup_frac):
@@ -38,10 +39,27 @@ def get_beta_schedule(beta_schedule, *, beta_start, beta_end, num_diffusion_time
   return betas
 
 
-def noise_like(shape, noise_fn=tf.random_normal, repeat=False, dtype=tf.float32): 
+def noise_like(shape, noise_fn=tf.random_normal, repeat=False, dtype=tf.float32, need_noise=None):
   repeat_noise = lambda: tf.repeat(noise_fn(shape=(1, *shape[1:]), dtype=dtype), repeats=shape[0], axis=0)
   noise = lambda: noise_fn(shape=shape, dtype=dtype)
-  return repeat_noise() if repeat else noise() # generate noise if need repeat
+  if isinstance(repeat, tf.Tensor):  # decided at run time, e.g. per step of a sampling loop
+    sample = lambda: tf.cond(repeat, repeat_noise, noise)
+  else:
+    sample = repeat_noise if repeat else noise # generate noise if need repeat
+  if need_noise is None:
+    return sample()
+  # need_noise is a boolean tensor; skip the RNG altogether when the noise would be masked out anyway
+  return tf.cond(need_noise, sample, lambda: tf.zeros(shape, dtype=dtype))
+
+
+# Per-timestep coefficients precomputed by GaussianDiffusion, in the row order of GaussianDiffusion._sched
+_SCHEDULE_KEYS = (
+  'betas', 'alphas_cumprod', 'alphas_cumprod_prev',
+  'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod', 'log_one_minus_alphas_cumprod',
+  'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod',
+  'posterior_variance', 'posterior_log_variance_clipped', 'posterior_std', 'posterior_mean_coef1', 'posterior_mean_coef2',
+  'model_mean_coef_xt', 'model_mean_coef_eps',
+)
 
 
 class GaussianDiffusion:
@@ -49,8 +67,9 @@ class GaussianDiffusion:
   Contains utilities for the diffusion model.
   """
 
-  def __init__(self, *, betas, loss_type, tf_dtype=tf.float32):
+  def __init__(self, *, betas, loss_type, tf_dtype=tf.float32, xla_jit=False):
     self.loss_type = loss_type  #initial the Type loss
+    self.xla_jit = xla_jit  # cluster the sampling loops and loss with XLA (TPU graphs are compiled by XLA anyway)
 
     assert isinstance(betas, np.ndarray) # ensure whether betas is of np.ndarray
     self.np_betas = betas = betas.astype(np.float64)  # computations here in float64 for accuracy
@@ -62,52 +81,102 @@ class GaussianDiffusion:
     alphas_cumprod = np.cumprod(alphas, axis=0) # \bar{\alpha_t} see the relationship above the equation (4)
     alphas_cumprod_prev = np.append(1., alphas_cumprod[:-1]) # the previous alpha (\bar{\alpha_{t-1}})
     assert alphas_cumprod_prev.shape == (timesteps,) # make sure the length of the previous alphabar
-    
-    # initial the beta and alpha
-    self.betas = tf.constant(betas, dtype=tf_dtype) 
-    self.alphas_cumprod = tf.constant(alphas_cumprod, dtype=tf_dtype)
-    self.alphas_cumprod_prev = tf.constant(alphas_cumprod_prev, dtype=tf_dtype)
+
+    sched = {'betas': betas, 'alphas_cumprod': alphas_cumprod, 'alphas_cumprod_prev': alphas_cumprod_prev}
 
     # calculations for diffusion q(x_t | x_{t-1}) and others
-    self.sqrt_alphas_cumprod = tf.constant(np.sqrt(alphas_cumprod), dtype=tf_dtype)  # \sqrt{\bar{\alpha_t}}
-    self.sqrt_one_minus_alphas_cumprod = tf.constant(np.sqrt(1. - alphas_cumprod), dtype=tf_dtype) # \sqrt{ 1 - \bar{\alpha_t}}
-    self.log_one_minus_alphas_cumprod = tf.constant(np.log(1. - alphas_cumprod), dtype=tf_dtype) # \log{ 1 - \bar{\alpha_t}}
-    self.sqrt_recip_alphas_cumprod = tf.constant(np.sqrt(1. / alphas_cumprod), dtype=tf_dtype) # \sqrt{ 1 / \bar{\alpha_t}}
-    self.sqrt_recipm1_alphas_cumprod = tf.constant(np.sqrt(1. / alphas_cumprod - 1), dtype=tf_dtype) # \sqrt{ 1 / \bar{\alpha_t} - 1 }
+    sched['sqrt_alphas_cumprod'] = np.sqrt(alphas_cumprod)  # \sqrt{\bar{\alpha_t}}
+    sched['sqrt_one_minus_alphas_cumprod'] = np.sqrt(1. - alphas_cumprod) # \sqrt{ 1 - \bar{\alpha_t}}
+    sched['log_one_minus_alphas_cumprod'] = np.log(1. - alphas_cumprod) # \log{ 1 - \bar{\alpha_t}}
+    sched['sqrt_recip_alphas_cumprod'] = np.sqrt(1. / alphas_cumprod) # \sqrt{ 1 / \bar{\alpha_t}}
+    sched['sqrt_recipm1_alphas_cumprod'] = np.sqrt(1. / alphas_cumprod - 1) # \sqrt{ 1 / \bar{\alpha_t} - 1 }
 
     # calculations for posterior q(x_{t-1} | x_t, x_0)
     posterior_variance = betas * (1. - alphas_cumprod_prev) / (1. - alphas_cumprod) # \tilde{\beta}_t in Eqn. (7)
     # above: equal to 1. / (1. / (1. - alpha_cumprod_tm1) + alpha_t / beta_t)
-    self.posterior_variance = tf.constant(posterior_variance, dtype=tf_dtype) # initialization 
+    sched['posterior_variance'] = posterior_variance
     # below: log calculation clipped because the posterior variance is 0 at the beginning of the diffusion chain
-    self.posterior_log_variance_clipped = tf.constant(np.log(np.maximum(posterior_variance, 1e-20)), dtype=tf_dtype)
-    self.posterior_mean_coef1 = tf.constant(    # the first term in Eqn. (7)
-      betas * np.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod), dtype=tf_dtype)
-    self.posterior_mean_coef2 = tf.constant(    # the second term in Eqn. (7)
-      (1. - alphas_cumprod_prev) * np.sqrt(alphas) / (1. - alphas_cumprod), dtype=tf_dtype)
+    sched['posterior_log_variance_clipped'] = np.log(np.maximum(posterior_variance, 1e-20))
+    sched['posterior_std'] = np.sqrt(np.maximum(posterior_variance, 1e-20)) # exp(0.5 * posterior_log_variance_clipped)
+    sched['posterior_mean_coef1'] = betas * np.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod) # the first term in Eqn. (7)
+    sched['posterior_mean_coef2'] = (1. - alphas_cumprod_prev) * np.sqrt(alphas) / (1. - alphas_cumprod) # the second term in Eqn. (7)
+
+    # calculations for the model mean with predict_start_from_noise substituted into q_posterior (no clipping):
+    # mean = coef1 * (sqrt_recip * x_t - sqrt_recipm1 * eps) + coef2 * x_t = coef_xt * x_t - coef_eps * eps
+    sched['model_mean_coef_xt'] = (
+      sched['posterior_mean_coef1'] * sched['sqrt_recip_alphas_cumprod'] + sched['posterior_mean_coef2'])
+    sched['model_mean_coef_eps'] = sched['posterior_mean_coef1'] * sched['sqrt_recipm1_alphas_cumprod']
+
+    # ship the whole schedule to the device as a single [len(_SCHEDULE_KEYS), T] constant; each row is also
+    # exposed under its own name, e.g. self.sqrt_alphas_cumprod.
+    assert set(sched) == set(_SCHEDULE_KEYS)
+    self._sched = tf.constant(np.stack([sched[k] for k in _SCHEDULE_KEYS], axis=0), dtype=tf_dtype)
+    for k, name in enumerate(_SCHEDULE_KEYS):
+      setattr(self, name, self._sched[k])
+
+  def _jit_scope(self):
+    """
+    Mark the ops built inside for XLA compilation so the per-step coefficient math fuses into a few kernels.
+    """
+    return tf.xla.experimental.jit_scope() if self.xla_jit else contextlib.suppress()
 
-  @staticmethod
-  def _extract(a, t, x_shape):
+  def _extract_all(self, t, x_shape, keys=None):
     """
-    Extract some coefficients at specified timesteps,
-    then reshape to [batch_size, 1, 1, 1, 1, ...] for broadcasting purposes.
+    Extract every schedule coefficient (or only those named in keys) at specified timesteps with a single gather,
+    as a dict of tensors reshaped to [batch_size, 1, 1, 1, 1, ...] for broadcasting purposes.
     """
     bs, = t.shape
     assert x_shape[0] == bs
-    out = tf.gather(a, t) # out has the same length as array t, out[i] = a[t[i]]
-    assert out.shape == [bs] 
-    return tf.reshape(out, [bs] + ((len(x_shape) - 1) * [1])) # reshape to [batch_size, 1, 1, 1, 1, ...]
+    if keys is None:
+      keys, sched = _SCHEDULE_KEYS, self._sched
+    else:  # row selection on a constant, folded away when the graph is optimized
+      sched = tf.gather(self._sched, [_SCHEDULE_KEYS.index(k) for k in keys])
+    out = tf.gather(sched, t, axis=1) # out[k, i] = sched[k, t[i]]
+    assert out.shape == [len(keys), bs]
+    out = tf.reshape(out, [len(keys), bs] + ((len(x_shape) - 1) * [1]))
+    return dict(zip(keys, tf.unstack(out, axis=0)))
+
+  def _extract_scalar(self, i, rank):
+    """
+    Extract every schedule coefficient at a single timestep i shared by the whole batch,
+    as a dict of tensors reshaped to [1, 1, 1, 1, ...] that broadcast against the batch.
+    """
+    assert i.shape == []
+    out = tf.gather(self._sched, i, axis=1) # out[k] = sched[k, i]
+    assert out.shape == [len(_SCHEDULE_KEYS)]
+    out = tf.reshape(out, [len(_SCHEDULE_KEYS)] + (rank * [1]))
+    return dict(zip(_SCHEDULE_KEYS, tf.unstack(out, axis=0)))
+
+  @staticmethod
+  def _static_shape(shape):
+    """
+    The sample shape as a tuple of Python ints. The samplers are specialized on it when the graph is built
+    (static loop shapes, TensorArray element shapes), so every dimension must be known.
+    """
+    assert isinstance(shape, (tuple, list))
+    return tuple(int(d) for d in shape)  # fails on None dimensions
+
+  @staticmethod
+  def _timestep_seq(start, batch_size):
+    """
+    The timesteps start, start - 1, ..., 0 of a sampling loop, both as scalars and tiled to [batch_size],
+    so that the loop body does not have to build the batched t on every step.
+    """
+    ts = tf.range(start, -1, -1)
+    return ts, tf.tile(ts[:, None], [1, batch_size])
 
   def q_mean_variance(self, x_start, t):
     """
     The mean and variance value in Eqn. (4)
     """
+    coefs = self._extract_all(
+      t, x_start.shape, keys=('sqrt_alphas_cumprod', 'alphas_cumprod', 'log_one_minus_alphas_cumprod'))
     # the mean value in right of Eqn. (4)
-    mean = self._extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start 
+    mean = coefs['sqrt_alphas_cumprod'] * x_start
     # the variance value in right part of Eqn. (4)
-    variance = self._extract(1. - self.alphas_cumprod, t, x_start.shape)
+    variance = 1. - coefs['alphas_cumprod']
     # the log value of variance
-    log_variance = self._extract(self.log_one_minus_alphas_cumprod, t, x_start.shape)
+    log_variance = coefs['log_one_minus_alphas_cumprod']
     return mean, variance, log_variance
 
   def q_sample(self, x_start, t, noise=None):
@@ -118,30 +187,26 @@ class GaussianDiffusion:
       # if noise is not given, generate noise from tf.random_normal in the same shape of x_start
       noise = tf.random_normal(shape=x_start.shape)
     assert noise.shape == x_start.shape # comfirm x_0 and noise are in the same shape
+    coefs = self._extract_all(t, x_start.shape, keys=('sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod'))
     # x_t(x_0, \varepsilon) = \sqrt{\bar{\alpha}_t} x_0 + \sqrt{1 - \bar{\alpha}_t} \varepsilon
-    return ( 
-        self._extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-        self._extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
-    )
+    return coefs['sqrt_alphas_cumprod'] * x_start + coefs['sqrt_one_minus_alphas_cumprod'] * noise
 
   def predict_start_from_noise(self, x_t, t, noise): #the reverse fomula of q_sample above
     assert x_t.shape == noise.shape # comfirm x_t and noise are in the same shape
-    return (  # the value in equation (10), x_0
-        self._extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-        self._extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
-    )
+    coefs = self._extract_all(t, x_t.shape, keys=('sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod'))
+    # the value in equation (10), x_0
+    return coefs['sqrt_recip_alphas_cumprod'] * x_t - coefs['sqrt_recipm1_alphas_cumprod'] * noise
 
   def q_posterior(self, x_start, x_t, t): # return the mean and varaince in Eqn. (6) 
     """
     Compute the mean and variance of the diffusion posterior q(x_{t-1} | x_t, x_0)
     """
     assert x_start.shape == x_t.shape
-    posterior_mean = (
-        self._extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-        self._extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
-    )
-    posterior_variance = self._extract(self.posterior_variance, t, x_t.shape)
-    posterior_log_variance_clipped = self._extract(self.posterior_log_variance_clipped, t, x_t.shape)
+    coefs = self._extract_all(t, x_t.shape, keys=(
+      'posterior_mean_coef1', 'posterior_mean_coef2', 'posterior_variance', 'posterior_log_variance_clipped'))
+    posterior_mean = coefs['posterior_mean_coef1'] * x_start + coefs['posterior_mean_coef2'] * x_t
+    posterior_variance = coefs['posterior_variance']
+    posterior_log_variance_clipped = coefs['posterior_log_variance_clipped']
     assert (posterior_mean.shape[0] == posterior_variance.shape[0] == posterior_log_variance_clipped.shape[0] ==
             x_start.shape[0])
     return posterior_mean, posterior_variance, posterior_log_variance_clipped
@@ -164,118 +229,173 @@ class GaussianDiffusion:
     if self.loss_type == 'noisepred':
       # predict the noise instead of x_start. seems to be weighted naturally like SNR
       assert x_recon.shape == x_start.shape
-      losses = nn.meanflat(tf.squared_difference(noise, x_recon)) # calculate the noise
+      # sub, square and mean over H, W, C written as one reduction so it fuses into a single pass
+      with self._jit_scope():
+        losses = tf.reduce_mean(tf.squared_difference(noise, x_recon), axis=[1, 2, 3]) # calculate the noise
     else:
       raise NotImplementedError(self.loss_type)
 
     assert losses.shape == [B]
     return losses
 
-  def p_mean_variance(self, denoise_fn, *, x, t, clip_denoised: bool):
+  def _p_mean(self, denoise_fn, *, x, t, clip_denoised: bool, t_scalar=None):
+    """
+    The mean of p(x_{t-1} | x_t) in Eqn. (7), together with the schedule coefficients gathered at t
+    """
     if self.loss_type == 'noisepred':
-      x_recon = self.predict_start_from_noise(x, t=t, noise=denoise_fn(x, t)) # the predicted x_0, see in Eqn. (10)
+      noise = denoise_fn(x, t)
     else:
       raise NotImplementedError(self.loss_type)
 
-    if clip_denoised:
+    # one gather serves predict_start_from_noise and q_posterior below
+    if t_scalar is None:
+      coefs = self._extract_all(t, x.shape)
+    else:
+      coefs = self._extract_scalar(t_scalar, len(x.shape))
+    if not clip_denoised:
+      # x_0 is never materialized: the posterior mean is a direct combination of x_t and the predicted noise
+      model_mean = coefs['model_mean_coef_xt'] * x - coefs['model_mean_coef_eps'] * noise
+    else:
+      # the predicted x_0, see in Eqn. (10)
+      x_recon = coefs['sqrt_recip_alphas_cumprod'] * x - coefs['sqrt_recipm1_alphas_cumprod'] * noise
       x_recon = tf.clip_by_value(x_recon, -1., 1.) #Clips tensor values to -1.0 and 1.0 #NOTE clip function cannot change the type of value automaticallty
+      model_mean = coefs['posterior_mean_coef1'] * x_recon + coefs['posterior_mean_coef2'] * x # Eqn. (7)
+    assert model_mean.shape == x.shape
+    return model_mean, coefs
 
-    model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start=x_recon, x_t=x, t=t) # Eqn. (7)
-    assert model_mean.shape == x_recon.shape == x.shape
-    assert posterior_variance.shape == posterior_log_variance.shape == [x.shape[0], 1, 1, 1]
+  def p_mean_variance(self, denoise_fn, *, x, t, clip_denoised: bool, t_scalar=None):
+    """
+    If t_scalar (the scalar timestep of a batch whose entries of t are all equal) is given, the coefficients are
+    gathered once for the whole batch and the returned variances have shape [1, 1, 1, 1] instead of [B, 1, 1, 1].
+    """
+    model_mean, coefs = self._p_mean(denoise_fn, x=x, t=t, clip_denoised=clip_denoised, t_scalar=t_scalar)
+    posterior_variance = coefs['posterior_variance']
+    posterior_log_variance = coefs['posterior_log_variance_clipped']
+    assert posterior_variance.shape == posterior_log_variance.shape == [
+      x.shape[0] if t_scalar is None else 1, 1, 1, 1]
     return model_mean, posterior_variance, posterior_log_variance # Eqn. (7)
 
-  def p_sample(self, denoise_fn, *, x, t, noise_fn, clip_denoised=True, repeat_noise=False):
+  def p_sample(self, denoise_fn, *, x, t, noise_fn, clip_denoised=True, repeat_noise=False, t_scalar=None,
+               noise_dtype=tf.float32, noise=None):
     """
     Sample from the model
+    The noise is drawn in noise_dtype (e.g. tf.bfloat16 to halve the RNG bandwidth) and upcast in the final sum,
+    unless it is passed in directly as noise.
     """
-    model_mean, _, model_log_variance = self.p_mean_variance(denoise_fn, x=x, t=t, clip_denoised=clip_denoised)
-    noise = noise_like(x.shape, noise_fn, repeat_noise) # create noise, \varepsilon
+    assert x.shape.is_fully_defined()
+    # the sampling path only needs the mean and the precomputed posterior standard deviation
+    model_mean, coefs = self._p_mean(denoise_fn, x=x, t=t, clip_denoised=clip_denoised, t_scalar=t_scalar)
+    # no noise when t == 0: fold the mask into the noise scale, a scalar when the timestep is shared by the batch
+    if t_scalar is None:
+      if noise is None:
+        noise = noise_like(x.shape, noise_fn, repeat_noise, dtype=noise_dtype) # create noise, \varepsilon
+      nonzero_mask = tf.reshape(tf.cast(tf.greater(t, 0), x.dtype), [x.shape[0]] + [1] * (len(x.shape) - 1))
+    else:
+      if noise is None:
+        # the whole batch is at t == 0 on the last step, so the noise need not be drawn at all
+        noise = noise_like(x.shape, noise_fn, repeat_noise, dtype=noise_dtype, need_noise=tf.greater(t_scalar, 0))
+      nonzero_mask = tf.cast(tf.greater(t_scalar, 0), x.dtype)
     assert noise.shape == x.shape
-    # no noise when t == 0
-    nonzero_mask = tf.reshape(1 - tf.cast(tf.equal(t, 0), tf.float32), [x.shape[0]] + [1] * (len(x.shape) - 1)) # when t==0, mask==0
-    return model_mean + nonzero_mask * tf.exp(0.5 * model_log_variance) * noise # the x_{t-1}, see the second line below Eqn. (11)
+    scale = nonzero_mask * coefs['posterior_std']
+    return model_mean + scale * tf.cast(noise, x.dtype) # the x_{t-1}, see the second line below Eqn. (11)
 
-  def p_sample_loop(self, denoise_fn, *, shape, noise_fn=tf.random_normal):
+  def p_sample_loop(self, denoise_fn, *, shape, noise_fn=tf.random_normal, noise_dtype=tf.float32,
+                    pregenerate_noise=False, clip_denoised=True):
     """
     Generate samples
+    Args:
+      clip_denoised (bool): Clip the predicted x_0 to [-1, 1] at every step. Without clipping, p_sample computes
+        the mean directly from x_t and the predicted noise.
+      pregenerate_noise (bool): Draw x_T and the noise of all T steps with a single noise_fn call of shape
+        [T + 1, *shape] (in noise_dtype) up front instead of one call per step. This trades T times the image memory
+        for one RNG launch, so it is only worthwhile for small images; pass a stateless noise_fn to make the samples
+        reproducible. Drawing everything from one buffer keeps x_T and the step noise distinct even then.
     """
-    i_0 = tf.constant(self.num_timesteps - 1, dtype=tf.int32)
-    assert isinstance(shape, (tuple, list))
-    img_0 = noise_fn(shape=shape, dtype=tf.float32)
-    _, img_final = tf.while_loop(  # Repeat body while the condition cond is true
-      cond=lambda i_, _: tf.greater_equal(i_, 0), #run until T==0
-      body=lambda i_, img_: [
-        i_ - 1,     
-        self.p_sample(denoise_fn=denoise_fn, x=img_, t=tf.fill([shape[0]], i_), noise_fn=noise_fn)#sample x_{t-1}
-      ],
-      loop_vars=[i_0, img_0],
-      shape_invariants=[i_0.shape, img_0.shape],
-      back_prop=False
-    )
+    shape = self._static_shape(shape)
+    elems = self._timestep_seq(self.num_timesteps - 1, shape[0])
+    if pregenerate_noise:
+      all_noise = noise_fn(shape=[self.num_timesteps + 1, *shape], dtype=noise_dtype)
+      img_0 = tf.cast(all_noise[0], tf.float32)
+      elems += (all_noise[1:],)
+    else:
+      img_0 = noise_fn(shape=shape, dtype=tf.float32)
+
+    def _step(img_, elems_):
+      i_, t_ = elems_[:2]
+      # sample x_{t-1}
+      return self.p_sample(denoise_fn=denoise_fn, x=img_, t=t_, noise_fn=noise_fn, clip_denoised=clip_denoised,
+                           t_scalar=i_, noise_dtype=noise_dtype, noise=elems_[2] if pregenerate_noise else None)
+
+    with self._jit_scope():
+      # fold over the static sequence T-1, ..., 0 so the trip count is known at graph construction;
+      # unlike tf.scan, tf.foldl keeps only the latest image instead of stacking all T of them
+      img_final = tf.foldl(_step, elems=elems, initializer=img_0, back_prop=False)
     assert img_final.shape == shape
     return img_final 
 
-  def p_sample_loop_trajectory(self, denoise_fn, *, shape, noise_fn=tf.random_normal, repeat_noise_steps=-1):
+  def p_sample_loop_trajectory(self, denoise_fn, *, shape, noise_fn=tf.random_normal, repeat_noise_steps=-1,
+                               noise_dtype=tf.float32, clip_denoised=True):
     """
     Generate samples, returning intermediate images
     Useful for visualizing how denoised images evolve over time
     Args:
       repeat_noise_steps (int): Number of denoising timesteps in which the same noise
         is used across the batch. If >= 0, the initial noise is the same for all batch elemements.
+      noise_dtype: dtype in which the per-step noise is drawn before being upcast, see p_sample.
+      clip_denoised (bool): Clip the predicted x_0 to [-1, 1] at every step, see p_sample_loop.
     """
-    i_0 = tf.constant(self.num_timesteps - 1, dtype=tf.int32)
-    assert isinstance(shape, (tuple, list))
+    shape = self._static_shape(shape)
     img_0 = noise_like(shape, noise_fn, repeat_noise_steps >= 0)
-    times = tf.Variable([i_0])
-    imgs = tf.Variable([img_0])
-    # Steps with repeated noise
-    times, imgs = tf.while_loop(
-      cond=lambda times_, _: tf.less_equal(self.num_timesteps - times_[-1], repeat_noise_steps),
-      body=lambda times_, imgs_: [
-        tf.concat([times_, [times_[-1] - 1]], 0),
-        tf.concat([imgs_, [self.p_sample(denoise_fn=denoise_fn,
-                                         x=imgs_[-1],
-                                         t=tf.fill([shape[0]], times_[-1]),
-                                         noise_fn=noise_fn,
-                                         repeat_noise=True)]], 0)
-      ],
-      loop_vars=[times, imgs],
-      shape_invariants=[tf.TensorShape([None, *i_0.shape]),
-                        tf.TensorShape([None, *img_0.shape])],
-      back_prop=False
-    )
-    # Steps with different noise for each batch element
-    times, imgs = tf.while_loop(
-      cond=lambda times_, _: tf.greater_equal(times_[-1], 0),
-      body=lambda times_, imgs_: [
-        tf.concat([times_, [times_[-1] - 1]], 0),
-        tf.concat([imgs_, [self.p_sample(denoise_fn=denoise_fn,
-                                         x=imgs_[-1],
-                                         t=tf.fill([shape[0]], times_[-1]),
-                                         noise_fn=noise_fn,
-                                         repeat_noise=False)]], 0)
-      ],
-      loop_vars=[times, imgs],
-      shape_invariants=[tf.TensorShape([None, *i_0.shape]),
-                        tf.TensorShape([None, *img_0.shape])],
-      back_prop=False
-    )
+
+    # preallocated buffer for the T + 1 images (img_0 included), carried as loop state and filled in place
+    imgs_ta = tf.TensorArray(tf.float32, size=self.num_timesteps + 1, element_shape=img_0.shape).write(0, img_0)
+    i_0 = tf.constant(self.num_timesteps - 1, dtype=tf.int32)
+    t_0 = tf.fill([shape[0]], i_0)  # the batched t is decremented along with i_ instead of refilled every step
+
+    def _loop_body(i_, t_, img_, imgs_ta_):
+      new_img = self.p_sample(denoise_fn=denoise_fn,
+                              x=img_,
+                              t=t_,
+                              noise_fn=noise_fn,
+                              clip_denoised=clip_denoised,
+                              # the first repeat_noise_steps steps share the same noise across the batch
+                              repeat_noise=tf.less_equal(self.num_timesteps - i_, repeat_noise_steps),
+                              t_scalar=i_,
+                              noise_dtype=noise_dtype)
+      return [i_ - 1, t_ - 1, new_img, imgs_ta_.write(self.num_timesteps - i_, new_img)]
+
+    with self._jit_scope():
+      _, _, _, imgs_ta = tf.while_loop(
+        cond=lambda i_, *_: tf.greater_equal(i_, 0),
+        body=_loop_body,
+        loop_vars=[i_0, t_0, img_0, imgs_ta],
+        maximum_iterations=self.num_timesteps,
+        back_prop=False
+      )
+    # times[k] labels imgs[k]: T-1 for the initial noise, down to -1 for the final sample
+    times = tf.range(self.num_timesteps - 1, -2, -1)
+    imgs = imgs_ta.stack()
     assert imgs[-1].shape == shape
     return times, imgs
 
-  def interpolate(self, denoise_fn, *, shape, noise_fn=tf.random_normal):
+  def interpolate(self, denoise_fn, *, shape, noise_fn=tf.random_normal, noise_dtype=tf.float32, num_lams=None,
+                  clip_denoised=True):
     """
     Interpolate between images.
     t == 0 means diffuse images for 1 timestep before mixing.
+    Args:
+      num_lams (int): If given, lam is a [num_lams] placeholder and all interpolants are denoised together
+        in one reverse diffusion over a batch of num_lams * B images (denoise_fn must accept that batch size);
+        x_interp then has shape [num_lams, *shape].
+      clip_denoised (bool): Clip the predicted x_0 to [-1, 1] at every step, see p_sample_loop.
     """
-    assert isinstance(shape, (tuple, list))
+    shape = self._static_shape(shape)
 
     # Placeholders for real samples to interpolate
     x1 = tf.placeholder(tf.float32, shape)
     x2 = tf.placeholder(tf.float32, shape)
     # lam == 0.5 averages diffused images.
-    lam = tf.placeholder(tf.float32, shape=())
+    lam = tf.placeholder(tf.float32, shape=() if num_lams is None else [num_lams])
     t = tf.placeholder(tf.int32, shape=())
 
     # Add noise via forward diffusion
@@ -287,22 +407,26 @@ class GaussianDiffusion:
 
     # Mix latents
     # Linear interpolation
-    xt_interp = (1 - lam) * xt1 + lam * xt2
+    if num_lams is None:
+      xt_interp = (1 - lam) * xt1 + lam * xt2
+    else:
+      lam_ = tf.reshape(lam, [num_lams] + len(shape) * [1])
+      xt_interp = tf.reshape((1 - lam_) * xt1[None] + lam_ * xt2[None], [num_lams * shape[0], *shape[1:]])
     # Constant variance interpolation
     # xt_interp = tf.sqrt(1 - lam * lam) * xt1 + lam * xt2
 
     # Reverse diffusion (similar to self.p_sample_loop)
     # t = tf.constant(t, dtype=tf.int32)
-    _, x_interp = tf.while_loop(
-      cond=lambda i_, _: tf.greater_equal(i_, 0),
-      body=lambda i_, img_: [
-        i_ - 1,
-        self.p_sample(denoise_fn=denoise_fn, x=img_, t=tf.fill([shape[0]], i_), noise_fn=noise_fn)
-      ],
-      loop_vars=[t, xt_interp],
-      shape_invariants=[t.shape, xt_interp.shape],
-      back_prop=False
-    )
-    assert x_interp.shape == shape
+    def _step(img_, i_and_t):
+      i_, t_ = i_and_t
+      return self.p_sample(denoise_fn=denoise_fn, x=img_, t=t_, noise_fn=noise_fn, clip_denoised=clip_denoised,
+                           t_scalar=i_, noise_dtype=noise_dtype)
+
+    with self._jit_scope():
+      x_interp = tf.foldl(
+        _step, elems=self._timestep_seq(t, int(xt_interp.shape[0])), initializer=xt_interp, back_prop=False)
+    if num_lams is not None:
+      x_interp = tf.reshape(x_interp, [num_lams, *shape])
+    assert x_interp.shape == (shape if num_lams is None else (num_lams, *shape))
 
     return x1, x2, lam, x_interp, t